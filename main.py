@@ -1,10 +1,18 @@
 import os
 import time
-import json
-import requests
+import asyncio
+import gzip
+import orjson
+import httpx
 import logging
-import unicodedata
 import math
+import pickle
+import unicodedata
+from email.utils import formatdate
+import numpy as np
+from collections import defaultdict
+from functools import lru_cache
+from typing import NamedTuple, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Location
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters,
@@ -17,10 +25,24 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 
 # --- Configuración de Caché y API de Carburantes ---
-CACHE_FILE = "gasolineras.json"
+# La caché en disco se guarda comprimida: el JSON del Ministerio repite los
+# nombres de campo en cada estación y comprime ~10x, lo que importa en discos
+# lentos/de red como los de Railway (descomprimir es más barato que leer esos
+# MB de más).
+CACHE_FILE = "gasolineras.json.gz"
+CACHE_PROCESADA_FILE = "gasolineras.pkl"  # Caché columnar ya procesada (ver _construir_cache)
+ETAG_FILE = "gasolineras.etag"  # ETag de la última descarga, para peticiones condicionales
 CACHE_TIEMPO = 6 * 60 * 60  # 6 horas (tiempo antes de volver a descargar los datos)
 URL_API = "https://sedeaplicaciones.minetur.gob.es/ServiciosRESTCarburantes/PreciosCarburantes/EstacionesTerrestres/"
 
+# Cliente HTTP asíncrono compartido a nivel de módulo: reutiliza la conexión
+# TCP+TLS con la API del Ministerio entre descargas (keep-alive) y, al ser
+# asíncrono, no bloquea el event loop de Telegram mientras la API responde.
+HTTP = httpx.AsyncClient(
+    timeout=httpx.Timeout(60.0),
+    headers={"User-Agent": "GasolinerasTelegramBot/1.0"},
+)
+
 # --- Configuración de Logging ---
 # Configura el formato de los logs y el nivel.
 # Cambia 'logging.INFO' a 'logging.DEBUG' si quieres ver más detalles en los logs.
@@ -35,101 +57,427 @@ ESPERANDO_CIUDAD = range(1) # Un estado para la conversación de búsqueda por c
 
 # --- Funciones de Utilidad ---
 
+# Tabla de traducción precompilada para quitar tildes/diéresis del español.
+# str.translate con esta tabla es una sola pasada en C, frente a la descomposición
+# NFD + generador por carácter que se usaba antes (muy costosa llamada por fila).
+_SIN_TILDES = str.maketrans(
+    "áàäâéèëêíìïîóòöôúùüûÁÀÄÂÉÈËÊÍÌÏÎÓÒÖÔÚÙÜÛñÑ",
+    "aaaaeeeeiiiioooouuuuAAAAEEEEIIIIOOOOUUUUnN",
+)
+
+# Tabla de borrado de marcas diacríticas combinantes (U+0300–U+036F), para el
+# caso raro de entrada ya descompuesta en NFD (algunos clientes/teclados la
+# envían así: "Málaga" llega como "Ma´laga" con tilde combinante). Borrar las
+# marcas con str.translate es una pasada en C, sin bucle por codepoint.
+_COMBINING = dict.fromkeys(range(0x0300, 0x0370), None)
+
+@lru_cache(maxsize=4096)
 def normalizar(texto):
     """
     Normaliza un texto (ej. nombre de ciudad): elimina tildes y convierte a minúsculas.
     Esto ayuda a hacer las búsquedas más flexibles e independientes de mayúsculas/minúsculas o acentos.
+    Memoizada: los nombres de ciudad se repiten entre usuarios (y entre filas
+    durante la reconstrucción de la caché), así que tras la primera vez cada
+    cadena se resuelve con una búsqueda O(1).
     """
-    logger.debug(f"Normalizando texto: '{texto}'")
-    return ''.join(
-        c for c in unicodedata.normalize('NFD', texto) # Normaliza a forma NFD (caracter + diacrítico)
-        if unicodedata.category(c) != 'Mn' # Filtra los diacríticos (tildes, etc.)
-    ).lower() # Convierte a minúsculas
+    # Atajo para el caso común (texto sin tildes ni eñes): str.isascii es una
+    # comprobación O(n) trivial en C y evita la pasada de str.translate.
+    if texto.isascii():
+        return texto.lower()
+    texto = texto.translate(_SIN_TILDES)
+    if texto.isascii():
+        return texto.lower()
+    # Quedan codepoints fuera de la tabla de tildes (p. ej. entrada ya
+    # descompuesta en NFD): se descompone y se borran las marcas combinantes.
+    return unicodedata.normalize("NFD", texto).translate(_COMBINING).lower()
+
+# Lock que protege la sección crítica del refresco: si varios usuarios consultan
+# a la vez con la caché caducada, solo una corrutina descarga; las demás esperan
+# y encuentran la caché ya fresca (evita la "estampida" de descargas duplicadas).
+_refresco_lock = asyncio.Lock()
+
+def _cache_caducada():
+    """Indica si el archivo de caché falta o su mtime excede CACHE_TIEMPO."""
+    if not os.path.exists(CACHE_FILE):
+        logger.info(f"Cache: El archivo '{CACHE_FILE}' no existe. Se requiere descarga inicial.")
+        return True
+    if (time.time() - os.path.getmtime(CACHE_FILE)) > CACHE_TIEMPO:
+        logger.info(f"Cache: El archivo '{CACHE_FILE}' ha caducado (más de {CACHE_TIEMPO / 3600:.1f} horas). Se requiere descarga.")
+        return True
+    # %-perezoso: la cadena solo se formatea si el nivel DEBUG está activo.
+    logger.debug("Cache: El archivo '%s' está actualizado. No se requiere descarga.", CACHE_FILE)
+    return False
 
-def descargar_si_es_necesario():
+async def descargar_si_es_necesario():
     """
     Gestiona la caché de datos de gasolineras.
     Descarga los datos de la API del Ministerio si el archivo de caché no existe
     o si su última modificación excede el tiempo definido en CACHE_TIEMPO.
+    La descarga es asíncrona y está protegida por un lock: con usuarios
+    concurrentes solo se lanza una petición por refresco.
     Retorna True si los datos están disponibles (descargados o ya en caché), False en caso contrario.
     """
-    descargar = False
-    if not os.path.exists(CACHE_FILE):
-        logger.info(f"Cache: El archivo '{CACHE_FILE}' no existe. Se requiere descarga inicial.")
-        descargar = True
-    elif (time.time() - os.path.getmtime(CACHE_FILE)) > CACHE_TIEMPO:
-        logger.info(f"Cache: El archivo '{CACHE_FILE}' ha caducado (más de {CACHE_TIEMPO / 3600:.1f} horas). Se requiere descarga.")
-        descargar = True
-    else:
-        logger.info(f"Cache: El archivo '{CACHE_FILE}' está actualizado. No se requiere descarga.")
+    if not _cache_caducada():
+        return True
+
+    async with _refresco_lock:
+        # Revalida dentro del lock: otra corrutina pudo completar la descarga
+        # mientras esta esperaba.
+        if not _cache_caducada():
+            return True
 
-    if descargar:
         logger.info("⛽ Iniciando descarga de datos de gasolineras desde la API del Ministerio...")
+
+        # Petición condicional: si ya hay una copia local, se anuncia su fecha
+        # (y el ETag de la descarga anterior, si se guardó) para que el
+        # servidor pueda contestar 304 Not Modified y ahorrarse el payload de
+        # varios MB cuando los datos no han cambiado.
+        cabeceras = {}
+        if os.path.exists(CACHE_FILE):
+            cabeceras["If-Modified-Since"] = formatdate(os.path.getmtime(CACHE_FILE), usegmt=True)
+            try:
+                with open(ETAG_FILE) as f:
+                    etag = f.read().strip()
+                if etag:
+                    cabeceras["If-None-Match"] = etag
+            except OSError:
+                pass
+
         try:
-            # Realiza la petición GET a la API con un timeout generoso de 60 segundos
-            r = requests.get(URL_API, timeout=60)
-            r.raise_for_status() # Lanza una excepción para códigos de estado HTTP 4xx/5xx
-            
-            # Guarda la respuesta JSON en el archivo de caché
-            with open(CACHE_FILE, "w", encoding="utf-8") as f:
-                json.dump(r.json(), f, ensure_ascii=False, indent=2)
+            # Descarga en streaming directamente a disco, en bloques de 64 KB:
+            # el payload de varios MB nunca se materializa entero en memoria
+            # (importante en contenedores pequeños como los de Railway). El
+            # servidor ya devuelve JSON válido, así que no hay nada que
+            # decodificar ni reserializar aquí; el parseo ocurre una sola vez,
+            # al leer el archivo. Se escribe a un archivo temporal y se renombra
+            # al final (os.replace es atómico): si la descarga se corta o el
+            # proceso muere a medias, la caché anterior queda intacta en lugar
+            # de un JSON truncado.
+            tmp = CACHE_FILE + ".tmp"
+            try:
+                async with HTTP.stream("GET", URL_API, headers=cabeceras) as r:
+                    if r.status_code == 304:
+                        # Los datos del servidor no han cambiado: basta con
+                        # refrescar el mtime local para renovar el TTL.
+                        os.utime(CACHE_FILE, None)
+                        logger.info("✅ La API respondió 304 Not Modified; se conserva la caché actual.")
+                        return True
+                    r.raise_for_status() # Lanza una excepción para códigos de estado HTTP 4xx/5xx
+                    # compresslevel=1: compresión mínima en CPU, suficiente
+                    # para el JSON tan repetitivo de la API.
+                    with gzip.open(tmp, "wb", compresslevel=1) as f:
+                        async for trozo in r.aiter_bytes(65536):
+                            f.write(trozo)
+                os.replace(tmp, CACHE_FILE)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+            # Guarda el ETag de esta descarga para la siguiente petición
+            # condicional (si el servidor no lo envía, se elimina el archivo).
+            try:
+                etag = r.headers.get("ETag")
+                if etag:
+                    with open(ETAG_FILE, "w") as f:
+                        f.write(etag)
+                elif os.path.exists(ETAG_FILE):
+                    os.remove(ETAG_FILE)
+            except OSError as e:
+                logger.warning(f"No se pudo persistir el ETag en '{ETAG_FILE}': {e}.")
+
             logger.info(f"✅ Datos guardados en '{CACHE_FILE}' correctamente.")
             return True # Descarga exitosa
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error(f"❌ Error al descargar los datos: Tiempo de espera excedido (Timeout). La API tardó demasiado en responder.")
             return False
-        except requests.exceptions.ConnectionError as e:
-            logger.error(f"❌ Error al descargar los datos (ConnectionError): Problema de red o conexión con la API: {e}")
+        except httpx.TransportError as e:
+            logger.error(f"❌ Error al descargar los datos (TransportError): Problema de red o conexión con la API: {e}")
             return False
-        except requests.exceptions.RequestException as e:
-            logger.error(f"❌ Error al descargar los datos (RequestException): Problema con la petición HTTP: {e}")
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Error al descargar los datos (HTTPError): Problema con la petición HTTP: {e}")
             return False
         except Exception as e:
             logger.error(f"❌ Error inesperado al descargar los datos: {e}")
             return False
-    return True # No se necesitó descarga o ya se había descargado con éxito
 
-def haversine(lat1, lon1, lat2, lon2):
+def haversine_np(lat1, lon1, lat2, lon2):
     """
-    Calcula la distancia Haversine entre dos puntos (latitud, longitud) en kilómetros.
-    Útil para encontrar gasolineras cercanas a una ubicación dada.
+    Calcula la distancia Haversine (en kilómetros) entre un punto (lat1, lon1)
+    y un array completo de puntos (lat2, lon2), evaluando toda la fórmula con
+    operaciones NumPy: una sola pasada en C sobre las columnas de coordenadas
+    en lugar de una llamada Python con math.sin/cos/atan2 por estación.
+    La forma con arcsin es numéricamente equivalente a la de atan2 para
+    distancias terrestres válidas y evita una operación trigonométrica.
     """
-    R = 6371  # Radio de la Tierra en kilómetros
-
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
+    R = 6371.0  # Radio de la Tierra en kilómetros
 
-    dlon = lon2_rad - lon1_rad
+    lat1_rad = np.radians(lat1)
+    lat2_rad = np.radians(lat2)
     dlat = lat2_rad - lat1_rad
+    dlon = np.radians(lon2 - lon1)
+
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlon / 2) ** 2
+    return R * 2 * np.arcsin(np.sqrt(a))
+
+# --- Caché en memoria de datos ya procesados ---
+# El archivo de caché solo cambia cada CACHE_TIEMPO, así que los precios,
+# coordenadas y el índice de municipios se calculan UNA vez por refresco
+# (no en cada consulta de usuario) y se guardan aquí, junto al mtime del
+# archivo para saber cuándo hay que reconstruirlos. "version" se incrementa en
+# cada reconstrucción y sirve como clave de invalidación para las memoizaciones
+# que dependen del contenido de la caché.
+_CACHE = {"mtime": None, "version": 0, "datos": None}
+
+# Lado de las celdas de la rejilla geográfica, en grados (~27 km de latitud):
+# las consultas por ubicación recuperan candidatas por celda en O(1) en lugar
+# de filtrar las columnas completas.
+_TAM_CELDA = 0.25
+
+def _a_columna_float(valores):
+    """
+    Convierte una columna de cadenas de la API (formato "1,459") a un array
+    float32 de una sola pasada vectorizada; los valores vacíos o no numéricos
+    quedan como NaN en lugar de provocar excepciones fila a fila.
+    float32 basta de sobra para precios de 3 decimales y coordenadas de ~5
+    decimales, y reduce a la mitad el tráfico de memoria de los filtros.
+    """
+    arr = np.char.replace(np.asarray([v if v else "nan" for v in valores], dtype=np.str_), ",", ".")
+    try:
+        return arr.astype(np.float32)
+    except ValueError:
+        # Caso raro: alguna fila trae un valor no numérico inesperado.
+        # Solo entonces se recurre a la conversión fila a fila.
+        def _flotante(s):
+            try:
+                return float(s)
+            except ValueError:
+                return math.nan
+        return np.asarray([_flotante(s) for s in arr], dtype=np.float32)
+
+def _construir_cache(datos):
+    """
+    Preprocesa la lista bruta de gasolineras de la API una sola vez por refresco,
+    en formato columnar (arrays paralelos, "struct of arrays"):
+    - Precios y coordenadas como arrays NumPy de float, convertidos en bloque
+      (las filas inválidas se descartan con una máscara vectorizada, sin
+      try/except por fila).
+    - Rótulo y dirección como listas paralelas para el renderizado.
+    - Índice invertido municipio_normalizado -> array de índices de fila, para que
+      la búsqueda por ciudad sea un acceso a diccionario y el top-3 trabaje sobre
+      arrays contiguos en lugar de recorrer ~11k dicts por consulta.
+    Retorna el diccionario columnar con todas las estructuras derivadas.
+    """
+    # Proyección de esquema en una sola pasada: de los ~25 campos por estación
+    # que devuelve la API solo se usan 7; el resto de los dicts brutos nunca
+    # llega a las estructuras de la caché y puede liberarse inmediatamente.
+    rotulos, direcciones, municipios, provincias = [], [], [], []
+    diesel_raw, gasolina_raw, lat_raw, lon_raw = [], [], [], []
+    for g in datos:
+        rotulos.append(g.get("Rótulo", "N/A"))
+        direcciones.append(g.get("Dirección", ""))
+        municipios.append(g.get("Municipio", ""))
+        provincias.append(g.get("Provincia", ""))
+        diesel_raw.append(g.get("Precio Gasoleo A"))
+        gasolina_raw.append(g.get("Precio Gasolina 95 E5"))
+        lat_raw.append(g.get("Latitud"))
+        lon_raw.append(g.get("Longitud (WGS84)"))
+    del datos  # El árbol de dicts de la API ya no hace falta
+
+    diesel = _a_columna_float(diesel_raw)
+    gasolina = _a_columna_float(gasolina_raw)
+    lat = _a_columna_float(lat_raw)
+    lon = _a_columna_float(lon_raw)
+
+    # Máscara vectorizada de filas válidas: los NaN (datos faltantes) quedan
+    # fuera automáticamente porque toda comparación con NaN es False.
+    with np.errstate(invalid="ignore"):
+        validas = (
+            (diesel > 0.0) & (gasolina > 0.0)
+            & ~((lat == 0.0) & (lon == 0.0))
+            & (np.abs(lat) <= 90.0) & (np.abs(lon) <= 180.0)
+        )
+    filas_validas = np.flatnonzero(validas)
+
+    indice = defaultdict(list)
+    indice_prov = defaultdict(list)
+    for fila_nueva, fila_original in enumerate(filas_validas.tolist()):
+        indice[normalizar(municipios[fila_original])].append(fila_nueva)
+        indice_prov[normalizar(provincias[fila_original])].append(fila_nueva)
+
+    # Estructura para la búsqueda por subcadena: todas las claves de municipio
+    # concatenadas con separador \x00. Buscar la subcadena con str.find sobre
+    # esta única cadena es una pasada en C, frente a un bucle Python con un
+    # test 'in' por cada uno de los ~8k municipios.
+    # Rejilla geográfica gruesa: cada estación válida se asigna a la celda de
+    # _TAM_CELDA grados que la contiene. Una consulta por ubicación solo mira
+    # las celdas alrededor del usuario, independientemente del tamaño total
+    # del dataset.
+    lat_validas = lat[validas]
+    lon_validas = lon[validas]
+    celda_y = np.floor(lat_validas / _TAM_CELDA).astype(np.int64)
+    celda_x = np.floor(lon_validas / _TAM_CELDA).astype(np.int64)
+    rejilla = defaultdict(list)
+    for fila, celda in enumerate(zip(celda_y.tolist(), celda_x.tolist())):
+        rejilla[celda].append(fila)
+
+    claves_municipios = list(indice.keys())
+    inicios = np.cumsum([0] + [len(c) + 1 for c in claves_municipios[:-1]]) if claves_municipios else np.array([], dtype=np.intp)
+
+    cache = {
+        "rotulo": [rotulos[i] for i in filas_validas],
+        "direccion": [direcciones[i] for i in filas_validas],
+        "diesel": diesel[validas],
+        "gasolina": gasolina[validas],
+        "lat": lat[validas],
+        "lon": lon[validas],
+        "indice_municipios": {muni: np.asarray(idx, dtype=np.intp) for muni, idx in indice.items()},
+        "claves_municipios": claves_municipios,
+        "municipios_unidos": "\x00".join(claves_municipios),
+        "inicios_municipios": inicios,
+        # Partición por provincia: permite restringir una búsqueda de ciudad a
+        # las ~cientos de estaciones de su provincia en lugar de toda España.
+        "indice_provincias": {prov: np.asarray(idx, dtype=np.intp) for prov, idx in indice_prov.items()},
+        "rejilla": {celda: np.asarray(idx, dtype=np.intp) for celda, idx in rejilla.items()},
+        # Enlaces de Google Maps ya construidos (https evita la redirección
+        # que sufría el enlace http al pulsar el botón): el renderizado queda
+        # en una lectura de atributo, sin formateo por estación y por consulta.
+        "maps_url": [f"https://maps.google.com/maps?q={la:.6f},{lo:.6f}"
+                     for la, lo in zip(lat_validas.tolist(), lon_validas.tolist())],
+    }
+    logger.info(f"Caché procesada: {len(filas_validas)} estaciones válidas en {len(indice)} municipios y {len(indice_prov)} provincias.")
+    return cache
+
+def _top_k(valores, k=3, desempate=None):
+    """
+    Posiciones de los k valores más bajos de 'valores', ordenadas de menor a mayor.
+    Usa np.argpartition (selección parcial O(n) en C) en lugar de ordenar todo el
+    array; solo los k supervivientes se ordenan al final. Con 'desempate' (p. ej.
+    distancias), los empates de precio se resuelven por ese segundo criterio.
+    """
+    if valores.size <= k:
+        seleccion = np.arange(valores.size)
+    else:
+        seleccion = np.argpartition(valores, k - 1)[:k]
+    if desempate is not None:
+        orden = np.lexsort((desempate[seleccion], valores[seleccion]))
+    else:
+        orden = np.argsort(valores[seleccion], kind="stable")
+    return seleccion[orden]
+
+class Estacion(NamedTuple):
+    """
+    Fila de estación materializada para el renderizado de mensajes. Al ser una
+    NamedTuple, cada registro ocupa una fracción de lo que ocuparía un dict
+    equivalente y el acceso por atributo resuelve en C por desplazamiento fijo,
+    sin el hash de claves de un dict.
+    """
+    rotulo: str
+    direccion: str
+    diesel: float
+    gasolina: float
+    lat: float
+    lon: float
+    maps_url: str
+    distancia: Optional[float] = None  # Solo en búsquedas por ubicación
+
+def _materializar_estaciones(cache, indices, distancias=None, registros=None):
+    """
+    Reconstruye registros Estacion (solo para las pocas filas ganadoras del
+    top-3) a partir de las columnas de la caché, para el renderizado de mensajes.
+    'registros' es un memo opcional fila -> Estacion compartido entre las listas
+    de diésel y gasolina: las estaciones que ganan en ambos combustibles (caso
+    frecuente) se materializan una sola vez.
+    """
+    estaciones = []
+    for j, i in enumerate(indices):
+        i = int(i)
+        g = registros.get(i) if registros is not None else None
+        if g is None:
+            g = Estacion(
+                rotulo=cache["rotulo"][i],
+                direccion=cache["direccion"][i],
+                # round() a 3 decimales: los precios viajan como float32 en las
+                # columnas y su double más cercano arrastra ruido (1,399 se
+                # convertiría en 1.399999976...); la API publica 3 decimales.
+                diesel=round(float(cache["diesel"][i]), 3),
+                gasolina=round(float(cache["gasolina"][i]), 3),
+                lat=float(cache["lat"][i]),
+                lon=float(cache["lon"][i]),
+                maps_url=cache["maps_url"][i],
+                distancia=float(distancias[j]) if distancias is not None else None,
+            )
+            if registros is not None:
+                registros[i] = g
+        estaciones.append(g)
+    return estaciones
+
+def _cargar_cache_procesada(mtime):
+    """
+    Parte bloqueante de la carga de datos (E/S de disco, parseo del JSON y
+    preprocesado): intenta recuperar la caché procesada persistida en disco y,
+    si no sirve, parsea el JSON, construye la caché columnar y la persiste.
+    Pensada para ejecutarse con asyncio.to_thread, fuera del event loop.
+    """
+    # Tras un reinicio del proceso, intenta recuperar la caché procesada
+    # persistida en disco: si su mtime coincide con el del JSON descargado,
+    # se evita reparsear y reprocesar el JSON completo.
+    if os.path.exists(CACHE_PROCESADA_FILE):
+        try:
+            with open(CACHE_PROCESADA_FILE, "rb") as f:
+                guardada = pickle.load(f)
+            if guardada.get("mtime") == mtime:
+                logger.info(f"Caché procesada recuperada de '{CACHE_PROCESADA_FILE}' (sin reparsear el JSON).")
+                return guardada["datos"]
+        except Exception as e:
+            logger.warning(f"No se pudo leer la caché procesada '{CACHE_PROCESADA_FILE}': {e}. Se reconstruirá.")
+
+    # Lectura en binario: orjson decodifica UTF-8 internamente sin pasar
+    # por una decodificación previa en Python.
+    with gzip.open(CACHE_FILE, "rb") as f:
+        datos = orjson.loads(f.read())["ListaEESSPrecio"]
+    logger.info(f"Cargados {len(datos)} estaciones de servicio desde '{CACHE_FILE}'.")
 
-    a = math.sin(dlat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    cache = _construir_cache(datos)
 
-    distance = R * c
-    logger.debug(f"Distancia calculada entre ({lat1:.4f},{lon1:.4f}) y ({lat2:.4f},{lon2:.4f}): {distance:.2f} km")
-    return distance
+    # Persiste la versión procesada para que el siguiente arranque no pague
+    # el coste del parseo JSON ni del preprocesado.
+    try:
+        with open(CACHE_PROCESADA_FILE, "wb") as f:
+            pickle.dump({"mtime": mtime, "datos": cache}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        logger.warning(f"No se pudo guardar la caché procesada en '{CACHE_PROCESADA_FILE}': {e}.")
+
+    return cache
 
-def obtener_datos_gasolineras():
+async def obtener_datos_gasolineras():
     """
-    Intenta cargar los datos de gasolineras desde el archivo de caché.
-    Si el caché no está actualizado o no existe, intenta descargarlos primero.
-    Retorna la lista de gasolineras o None si hay un error crítico.
+    Retorna la caché en memoria de gasolineras ya procesadas (ver _construir_cache).
+    Si el archivo de caché no está actualizado o no existe, intenta descargarlo primero;
+    solo se reparsea el JSON cuando el mtime del archivo cambia.
+    Retorna el diccionario _CACHE o None si hay un error crítico.
     """
-    if not descargar_si_es_necesario():
-        logger.error("No se pudieron obtener los datos de 'gasolineras.json' (falló la descarga o no se pudo acceder).")
+    if not await descargar_si_es_necesario():
+        logger.error(f"No se pudieron obtener los datos de '{CACHE_FILE}' (falló la descarga o no se pudo acceder).")
         return None
 
     try:
-        with open(CACHE_FILE, encoding="utf-8") as f:
-            datos = json.load(f)["ListaEESSPrecio"]
-            logger.info(f"Cargados {len(datos)} estaciones de servicio desde '{CACHE_FILE}'.")
-            return datos
+        mtime = os.path.getmtime(CACHE_FILE)
+        if mtime == _CACHE["mtime"] and _CACHE["datos"] is not None:
+            logger.debug("Caché en memoria vigente; no se reparsea el JSON.")
+            return _CACHE["datos"]
+
+        # El parseo del JSON de varios MB y el preprocesado tardan lo bastante
+        # como para congelar el event loop si se ejecutan en él; al delegarlos
+        # en un hilo del executor, el bot sigue atendiendo al resto de usuarios
+        # mientras se reconstruye la caché.
+        _CACHE["datos"] = await asyncio.to_thread(_cargar_cache_procesada, mtime)
+        _CACHE["mtime"] = mtime
+        _CACHE["version"] += 1
+        return _CACHE["datos"]
     except FileNotFoundError:
         logger.error(f"❌ Error: El archivo '{CACHE_FILE}' no se encontró después de intentar asegurar su existencia. Esto es inesperado.")
         return None
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"❌ Error al decodificar JSON de '{CACHE_FILE}': {e}. El archivo podría estar corrupto o vacío.")
         # Opcional: Podrías intentar borrar el archivo corrupto aquí para forzar una nueva descarga en el siguiente intento.
         return None
@@ -140,62 +488,150 @@ def obtener_datos_gasolineras():
         logger.error(f"❌ Error inesperado al leer los datos de gasolineras desde '{CACHE_FILE}': {e}")
         return None
 
-def filtrar_y_obtener_top_3(gasolineras, criterio_busqueda, tipo_busqueda="ciudad", umbral_distancia=20):
+def _municipios_con_subcadena(cache, criterio):
+    """
+    Claves de municipio que contienen 'criterio' como subcadena, localizadas con
+    str.find sobre la cadena concatenada de municipios (una sola pasada en C).
+    El separador \x00 garantiza que ninguna coincidencia cruce dos municipios.
+    """
+    unidos = cache["municipios_unidos"]
+    inicios = cache["inicios_municipios"]
+    claves = cache["claves_municipios"]
+    encontrados = set()
+    pos = unidos.find(criterio)
+    while pos != -1:
+        encontrados.add(int(np.searchsorted(inicios, pos, side="right")) - 1)
+        pos = unidos.find(criterio, pos + 1)
+    return [claves[i] for i in sorted(encontrados)]
+
+def _indices_ciudad(cache, criterio, provincia=None):
+    """
+    Índices de fila de las gasolineras de un municipio: acceso directo al índice
+    para coincidencia exacta, con fallback a búsqueda de subcadena, y restricción
+    opcional a una provincia ("ciudad, provincia" desambigua municipios homónimos).
     """
-    Filtra la lista de gasolineras y obtiene las 3 más baratas para diésel y gasolina.
-    Puede filtrar por ciudad o por cercanía a una ubicación (lat/lon).
+    indice = cache["indice_municipios"]
+    indices = indice.get(criterio)
+    if indices is None:
+        grupos = [indice[muni] for muni in _municipios_con_subcadena(cache, criterio)]
+        indices = np.concatenate(grupos) if grupos else np.array([], dtype=np.intp)
+    if provincia:
+        filas_provincia = cache["indice_provincias"].get(provincia)
+        if filas_provincia is not None:
+            indices = np.intersect1d(indices, filas_provincia)
+        else:
+            logger.info("Provincia '%s' no reconocida; se ignora la restricción.", provincia)
+    return indices
+
+@lru_cache(maxsize=512)
+def _indices_ciudad_cacheado(criterio, provincia, version):
     """
-    filtradas = []
-    logger.info(f"Iniciando filtrado por {tipo_busqueda} para criterio: '{criterio_busqueda}'")
+    Memoiza por (ciudad, provincia, versión de caché) los índices filtrados de una
+    búsqueda por ciudad. 'version' cambia con cada reconstrucción de la caché, con
+    lo que las entradas antiguas se invalidan solas; se guardan tuplas de índices
+    (pequeñas y hashables), no las estaciones materializadas.
+    Lee la caché del módulo (_CACHE) porque los argumentos deben ser hashables.
+    """
+    return tuple(_indices_ciudad(_CACHE["datos"], criterio, provincia).tolist())
 
-    for g in gasolineras:
-        try:
-            # Limpiar y convertir precios y coordenadas a float, usando .get() para seguridad
-            diesel = float(g.get("Precio Gasoleo A", "0").replace(",", "."))
-            gasolina = float(g.get("Precio Gasolina 95 E5", "0").replace(",", "."))
-            g_lat = float(g.get("Latitud", "0").replace(",", "."))
-            g_lon = float(g.get("Longitud (WGS84)", "0").replace(",", "."))
-            
-            # Validar precios y coordenadas (valores 0.0 o menos suelen ser datos faltantes/inválidos)
-            if diesel <= 0.0 or gasolina <= 0.0:
-                logger.debug(f"Saltando gasolinera '{g.get('Rótulo', 'N/A')}' por precio inválido (Diésel: {diesel}, Gasolina: {gasolina}).")
-                continue
-            if (g_lat == 0.0 and g_lon == 0.0) or not (-90 <= g_lat <= 90 and -180 <= g_lon <= 180):
-                logger.debug(f"Saltando gasolinera '{g.get('Rótulo', 'N/A')}' por coordenadas inválidas ({g_lat},{g_lon}).")
-                continue
-
-            es_valida = False
-            if tipo_busqueda == "ciudad":
-                municipio = normalizar(g.get("Municipio", ""))
-                if criterio_busqueda in municipio: # Búsqueda de subcadena en el municipio normalizado
-                    es_valida = True
-            elif tipo_busqueda == "ubicacion":
-                user_lat, user_lon = criterio_busqueda
-                dist = haversine(user_lat, user_lon, g_lat, g_lon)
-                if dist <= umbral_distancia: # Filtrar por distancia máxima
-                    g["distancia"] = dist
-                    es_valida = True
-            
-            if es_valida:
-                g["diesel"] = diesel
-                g["gasolina"] = gasolina
-                filtradas.append(g)
-        except (ValueError, KeyError) as e:
-            logger.debug(f"Saltando gasolinera '{g.get('Rótulo', 'N/A')}' debido a error al procesar datos: {e}. Datos brutos: {g}")
-            continue # Continúa con la siguiente gasolinera si los datos no son válidos
-
-    if not filtradas:
-        logger.info(f"No se encontraron gasolineras que cumplan el criterio para '{criterio_busqueda}'.")
+def filtrar_y_obtener_top_3(cache, criterio_busqueda, tipo_busqueda="ciudad", umbral_distancia=20, provincia=None):
+    """
+    Filtra las gasolineras ya procesadas (ver _construir_cache) y obtiene las 3 más
+    baratas para diésel y gasolina.
+    Puede filtrar por ciudad (vía el índice de municipios, con fallback a búsqueda
+    de subcadena, y opcionalmente restringida a una provincia) o por cercanía a
+    una ubicación (lat/lon).
+    """
+    # %-perezoso en las trazas por consulta: el logger solo formatea la cadena
+    # si el nivel configurado lo permite.
+    logger.info("Iniciando filtrado por %s para criterio: '%s'", tipo_busqueda, criterio_busqueda)
+
+    distancias = None
+    if tipo_busqueda == "ciudad":
+        # El resultado por ciudad es una función pura de (ciudad, provincia,
+        # versión de caché): las consultas repetidas de ciudades populares
+        # (Madrid, Barcelona...) salen directamente de la memoización.
+        indices = _indices_ciudad_cacheado(criterio_busqueda, provincia, _CACHE["version"])
+        indices = np.asarray(indices, dtype=np.intp)
+    else:
+        # Prefiltro por caja delimitadora: comparar grados es mucho más barato
+        # que la trigonometría de Haversine, y descarta >99% de las estaciones
+        # de España antes de calcular ninguna distancia real. 1 grado de
+        # latitud ≈ 111 km; el margen de longitud se ensancha con cos(lat).
+        # Los escalares del usuario se convierten a float32 para que toda la
+        # aritmética con las columnas se quede en float32 (sin promoción a
+        # float64 ni copias intermedias del doble de tamaño).
+        user_lat = np.float32(criterio_busqueda[0])
+        user_lon = np.float32(criterio_busqueda[1])
+        lat_col, lon_col = cache["lat"], cache["lon"]
+        margen_lat = umbral_distancia / 111.0
+        margen_lon = margen_lat / max(math.cos(math.radians(user_lat)), 0.1)
+
+        # Recuperación por rejilla: solo las celdas que pueden solaparse con el
+        # radio de búsqueda aportan candidatas (O(1) respecto al total de
+        # estaciones). El get() cubre cachés persistidas sin rejilla.
+        rejilla = cache.get("rejilla")
+        if rejilla:
+            celda_y = math.floor(user_lat / _TAM_CELDA)
+            celda_x = math.floor(user_lon / _TAM_CELDA)
+            anillo_y = max(1, math.ceil(margen_lat / _TAM_CELDA))
+            anillo_x = max(1, math.ceil(margen_lon / _TAM_CELDA))
+            grupos = [rejilla[(celda_y + dy, celda_x + dx)]
+                      for dy in range(-anillo_y, anillo_y + 1)
+                      for dx in range(-anillo_x, anillo_x + 1)
+                      if (celda_y + dy, celda_x + dx) in rejilla]
+            base = np.concatenate(grupos) if grupos else np.array([], dtype=np.intp)
+        else:
+            base = np.arange(lat_col.size, dtype=np.intp)
+
+        en_caja = (np.abs(lat_col[base] - user_lat) < margen_lat) & (np.abs(lon_col[base] - user_lon) < margen_lon)
+        candidatas = base[en_caja]
+
+        # Haversine vectorizado solo sobre las pocas candidatas de la caja.
+        dist = haversine_np(user_lat, user_lon, lat_col[candidatas], lon_col[candidatas])
+        dentro = dist <= umbral_distancia # Filtrar por distancia máxima
+        indices = candidatas[dentro]
+        distancias = dist[dentro]
+
+    if indices.size == 0:
+        logger.info("No se encontraron gasolineras que cumplan el criterio para '%s'.", criterio_busqueda)
         return None, f"⚠️ No se encontraron gasolineras que cumplan los criterios de búsqueda (precios válidos, coordenadas, o distancia/ciudad). Prueba con un nombre de ciudad más general o amplía el rango de búsqueda."
 
-    # Ordena las gasolineras filtradas por precio para obtener el top 3
+    # Selecciona el top 3 por precio con np.argpartition: selección O(n) en C
+    # sobre el array de precios filtrado, sin callbacks de Python por elemento.
     # Si es por ubicación, también considera la distancia en caso de precios iguales.
-    top_diesel = sorted(filtradas, key=lambda x: (x["diesel"], x.get("distancia", 0)))[:3]
-    top_gasolina = sorted(filtradas, key=lambda x: (x["gasolina"], x.get("distancia", 0)))[:3]
+    diesel_col, gasolina_col = cache["diesel"], cache["gasolina"]
+    orden_diesel = _top_k(diesel_col[indices], desempate=distancias)
+    orden_gasolina = _top_k(gasolina_col[indices], desempate=distancias)
+    if distancias is not None:
+        registros = {} # Memo compartido: las filas que ganan en ambos tops se crean una vez
+        top_diesel = _materializar_estaciones(cache, indices[orden_diesel], distancias[orden_diesel], registros)
+        top_gasolina = _materializar_estaciones(cache, indices[orden_gasolina], distancias[orden_gasolina], registros)
+    else:
+        registros = {}
+        top_diesel = _materializar_estaciones(cache, indices[orden_diesel], registros=registros)
+        top_gasolina = _materializar_estaciones(cache, indices[orden_gasolina], registros=registros)
 
-    logger.info(f"Encontradas {len(top_diesel)} top diésel y {len(top_gasolina)} top gasolina para '{criterio_busqueda}'.")
+    logger.info("Encontradas %d top diésel y %d top gasolina para '%s'.", len(top_diesel), len(top_gasolina), criterio_busqueda)
     return (top_diesel, top_gasolina), None
 
+def _render_top(top, combustible, etiqueta, titulo):
+    """
+    Construye los fragmentos de texto y las filas de botones de mapa para una
+    sección de top-3 (compartido por recibir_ciudad y recibir_ubicacion).
+    'combustible' es el atributo de precio de Estacion a mostrar, 'etiqueta' el
+    texto del botón y 'titulo' la cabecera de la sección.
+    Retorna (partes_de_mensaje, filas_de_teclado).
+    """
+    partes = [f"⛽ *{titulo}*\n"]
+    filas = []
+    for g in top:
+        precio = getattr(g, combustible)
+        sufijo = f" ({g.distancia:.2f} km)" if g.distancia is not None else ""
+        partes.append(f"• {g.rotulo} - {precio} €{sufijo}\n  📍 {g.direccion}\n")
+        filas.append([InlineKeyboardButton(f"📍 {g.rotulo} ({etiqueta})", url=g.maps_url)])
+    return partes, filas
+
 # --- Manejadores de Comandos del Bot ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -210,7 +646,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def precio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el comando /precio. Pide al usuario que ingrese una ciudad o su ubicación."""
     logger.info(f"Comando /precio recibido de usuario {update.effective_user.id}")
-    await update.message.reply_text("📍 ¿Qué ciudad quieres consultar? O si lo prefieres, ¡envíame tu ubicación actual!")
+    await update.message.reply_text(
+        "📍 ¿Qué ciudad quieres consultar? Puedes afinar con \"ciudad, provincia\". "
+        "O si lo prefieres, ¡envíame tu ubicación actual!"
+    )
     return ESPERANDO_CIUDAD # Cambia el estado a ESPERANDO_CIUDAD para la conversación
 
 async def recibir_ciudad(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -221,14 +660,25 @@ async def recibir_ciudad(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ciudad = update.message.text
     logger.info(f"Mensaje de texto recibido de usuario {update.effective_user.id} (asumiendo ciudad): '{ciudad}'")
 
+    # Soporta "ciudad, provincia" para desambiguar municipios homónimos y
+    # restringir la búsqueda a la partición de esa provincia.
+    provincia = None
+    if "," in ciudad:
+        ciudad, provincia = ciudad.split(",", 1)
+        ciudad = ciudad.strip()
+        provincia = provincia.strip()
+
     # Intenta obtener los datos de gasolineras (descargará si es necesario)
-    gasolineras_disponibles = obtener_datos_gasolineras()
-    if gasolineras_disponibles is None:
+    cache_gasolineras = await obtener_datos_gasolineras()
+    if cache_gasolineras is None:
         await update.message.reply_text(f"❌ Lo siento, no pude cargar los datos de gasolineras. Por favor, inténtalo de nuevo más tarde.")
         return ConversationHandler.END # Termina la conversación
 
     # Filtra y obtiene el top 3 por la ciudad proporcionada
-    resultado, error = filtrar_y_obtener_top_3(gasolineras_disponibles, normalizar(ciudad), tipo_busqueda="ciudad")
+    resultado, error = filtrar_y_obtener_top_3(
+        cache_gasolineras, normalizar(ciudad), tipo_busqueda="ciudad",
+        provincia=normalizar(provincia) if provincia else None,
+    )
 
     # Si hay un error en el filtrado (no se encontraron gasolineras), envía el error y termina.
     if error:
@@ -236,41 +686,26 @@ async def recibir_ciudad(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(error)
         return ConversationHandler.END
     
-    # Si hay resultados, construye y envía el mensaje
+    # Si hay resultados, construye y envía el mensaje con el renderizador
+    # compartido (las coordenadas ya vienen parseadas como float de la caché,
+    # así que no hay nada que reconvertir aquí).
     top_diesel, top_gasolina = resultado
     full_keyboard = [] # Para los botones de mapa
-
-    msg_content = "" # Variable para construir el cuerpo del mensaje
+    partes = [] # Fragmentos del cuerpo del mensaje
+    ciudad_titulo = ciudad.title() # Una sola pasada de titulación, no una por sección
 
     if top_diesel:
-        msg_content += f"⛽ *Top 3 Diésel en {ciudad.title()}*\n"
-        for i, g in enumerate(top_diesel):
-            try:
-                lat = float(g.get("Latitud", "0").replace(",", "."))
-                lon = float(g.get("Longitud (WGS84)", "0").replace(",", "."))
-                # URL de Google Maps para abrir la ubicación
-                Maps_url = f"http://maps.google.com/maps?q={lat},{lon}" 
-                
-                msg_content += f"• {g['Rótulo']} - {g['diesel']} €\n  📍 {g['Dirección']}\n"
-                full_keyboard.append([InlineKeyboardButton(f"📍 {g['Rótulo']} (Diésel)", url=Maps_url)])
-            except (ValueError, KeyError) as e:
-                msg_content += f"• {g['Rótulo']} - {g['diesel']} €\n  📍 {g['Dirección']} (Coordenadas no disponibles)\n"
-                logger.warning(f"Coordenadas inválidas para gasolinera {g.get('Rótulo', 'N/A')} en búsqueda por ciudad: {e}")
+        seccion, filas = _render_top(top_diesel, "diesel", "Diésel", f"Top 3 Diésel en {ciudad_titulo}")
+        partes += seccion
+        full_keyboard += filas
 
     if top_gasolina:
-        if msg_content: msg_content += "\n" # Añade un salto de línea si ya hay contenido de diésel
-        msg_content += f"⛽ *Top 3 Gasolina 95 en {ciudad.title()}*\n"
-        for i, g in enumerate(top_gasolina):
-            try:
-                lat = float(g.get("Latitud", "0").replace(",", "."))
-                lon = float(g.get("Longitud (WGS84)", "0").replace(",", "."))
-                Maps_url = f"http://maps.google.com/maps?q={lat},{lon}"
-                
-                msg_content += f"• {g['Rótulo']} - {g['gasolina']} €\n  📍 {g['Dirección']}\n"
-                full_keyboard.append([InlineKeyboardButton(f"📍 {g['Rótulo']} (Gasolina)", url=Maps_url)])
-            except (ValueError, KeyError) as e:
-                msg_content += f"• {g['Rótulo']} - {g['gasolina']} €\n  📍 {g['Dirección']} (Coordenadas no disponibles)\n"
-                logger.warning(f"Coordenadas inválidas para gasolinera {g.get('Rótulo', 'N/A')} en búsqueda por ciudad: {e}")
+        if partes: partes.append("\n") # Añade un salto de línea si ya hay contenido de diésel
+        seccion, filas = _render_top(top_gasolina, "gasolina", "Gasolina", f"Top 3 Gasolina 95 en {ciudad_titulo}")
+        partes += seccion
+        full_keyboard += filas
+
+    msg_content = "".join(partes)
 
     # Fallback final si por alguna razón el mensaje sigue vacío
     if not msg_content.strip(): # .strip() para verificar si no hay solo espacios en blanco
@@ -296,13 +731,13 @@ async def recibir_ubicacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔎 Buscando gasolineras cercanas a tu ubicación (radio de 20 km)...")
 
     # Intenta obtener los datos de gasolineras (descargará si es necesario)
-    gasolineras_disponibles = obtener_datos_gasolineras()
-    if gasolineras_disponibles is None:
+    cache_gasolineras = await obtener_datos_gasolineras()
+    if cache_gasolineras is None:
         await update.message.reply_text(f"❌ Lo siento, no pude cargar los datos de gasolineras. Por favor, inténtalo de nuevo más tarde.")
         return ConversationHandler.END # Termina la conversación
 
     # Filtra y obtiene el top 3 por cercanía a la ubicación
-    resultado, error = filtrar_y_obtener_top_3(gasolineras_disponibles, (user_lat, user_lon), tipo_busqueda="ubicacion", umbral_distancia=20)
+    resultado, error = filtrar_y_obtener_top_3(cache_gasolineras, (user_lat, user_lon), tipo_busqueda="ubicacion", umbral_distancia=20)
 
     # Si hay un error en el filtrado, envía el error y termina.
     if error:
@@ -310,38 +745,25 @@ async def recibir_ubicacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(error)
         return ConversationHandler.END
 
-    # Si hay resultados, construye y envía el mensaje
+    # Si hay resultados, construye y envía el mensaje con el renderizador
+    # compartido; la distancia de cada estación se muestra automáticamente
+    # porque viene rellena en los registros de la búsqueda por ubicación.
     top_diesel, top_gasolina = resultado
     full_keyboard = []
-
-    msg_content = ""
+    partes = []
 
     if top_diesel:
-        msg_content += f"⛽ *Top 3 Diésel cerca de ti*\n"
-        for i, g in enumerate(top_diesel):
-            try:
-                lat = float(g.get("Latitud", "0").replace(",", "."))
-                lon = float(g.get("Longitud (WGS84)", "0").replace(",", "."))
-                Maps_url = f"http://maps.google.com/maps?q={lat},{lon}"
-                msg_content += f"• {g['Rótulo']} - {g['diesel']} € ({g['distancia']:.2f} km)\n  📍 {g['Dirección']}\n"
-                full_keyboard.append([InlineKeyboardButton(f"📍 {g['Rótulo']} (Diésel)", url=Maps_url)])
-            except (ValueError, KeyError) as e:
-                msg_content += f"• {g['Rótulo']} - {g['diesel']} € ({g['distancia']:.2f} km)\n  📍 {g['Dirección']} (Coordenadas no disponibles)\n"
-                logger.warning(f"Coordenadas inválidas para gasolinera {g.get('Rótulo', 'N/A')} en búsqueda por ubicación: {e}")
+        seccion, filas = _render_top(top_diesel, "diesel", "Diésel", "Top 3 Diésel cerca de ti")
+        partes += seccion
+        full_keyboard += filas
 
     if top_gasolina:
-        if msg_content: msg_content += "\n" # Añade un salto de línea si ya hay contenido de diésel
-        msg_content += f"⛽ *Top 3 Gasolina 95 cerca de ti*\n"
-        for i, g in enumerate(top_gasolina):
-            try:
-                lat = float(g.get("Latitud", "0").replace(",", "."))
-                lon = float(g.get("Longitud (WGS84)", "0").replace(",", "."))
-                Maps_url = f"http://maps.google.com/maps?q={lat},{lon}"
-                msg_content += f"• {g['Rótulo']} - {g['gasolina']} € ({g['distancia']:.2f} km)\n  📍 {g['Dirección']}\n"
-                full_keyboard.append([InlineKeyboardButton(f"📍 {g['Rótulo']} (Gasolina)", url=Maps_url)])
-            except (ValueError, KeyError) as e:
-                msg_content += f"• {g['Rótulo']} - {g['gasolina']} € ({g['distancia']:.2f} km)\n  📍 {g['Dirección']} (Coordenadas no disponibles)\n"
-                logger.warning(f"Coordenadas inválidas para gasolinera {g.get('Rótulo', 'N/A')} en búsqueda por ubicación: {e}")
+        if partes: partes.append("\n") # Añade un salto de línea si ya hay contenido de diésel
+        seccion, filas = _render_top(top_gasolina, "gasolina", "Gasolina", "Top 3 Gasolina 95 cerca de ti")
+        partes += seccion
+        full_keyboard += filas
+
+    msg_content = "".join(partes)
 
     # Fallback final si el mensaje sigue vacío
     if not msg_content.strip():
@@ -354,6 +776,20 @@ async def recibir_ubicacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(msg_content, parse_mode="Markdown", reply_markup=reply_markup)
     return ConversationHandler.END # Termina la conversación
 
+async def refrescar_cache_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Tarea periódica de la JobQueue: refresca la caché de gasolineras en segundo
+    plano cada CACHE_TIEMPO. Así el coste de descarga/procesado se paga una sola
+    vez por intervalo (y no dentro de la consulta de ningún usuario), y la caché
+    compartida queda publicada en bot_data para todo el proceso.
+    """
+    logger.info("Job periódico: refrescando la caché de gasolineras en segundo plano...")
+    datos = await obtener_datos_gasolineras()
+    if datos is not None:
+        context.application.bot_data["gasolineras"] = datos
+    else:
+        logger.warning("Job periódico: no se pudo refrescar la caché; se reintentará en el siguiente intervalo.")
+
 async def cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el comando /cancelar. Termina la conversación actual."""
     logger.info(f"Comando /cancelar recibido de usuario {update.effective_user.id}")
@@ -362,6 +798,16 @@ async def cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Configuración y Ejecución Principal del Bot ---
 if __name__ == "__main__":
+    # uvloop (event loop en C sobre libuv) baja la latencia del camino de cada
+    # petición del webhook; es opcional y no está disponible en Windows, así
+    # que su ausencia simplemente deja el event loop por defecto de asyncio.
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("uvloop instalado como event loop.")
+    except ImportError:
+        logger.info("uvloop no disponible; se usa el event loop por defecto de asyncio.")
+
     logger.info("Iniciando configuración de la aplicación Telegram Bot...")
 
     # Verifica que las variables de entorno estén configuradas
@@ -395,6 +841,11 @@ if __name__ == "__main__":
     app.add_handler(CommandHandler("start", start)) # Manejador para el comando /start
     app.add_handler(conv_handler) # Añade el ConversationHandler
 
+    # Refresco periódico de la caché en segundo plano (first=0 la precalienta
+    # en el arranque): las consultas de usuario siempre encuentran la caché
+    # en memoria ya construida.
+    app.job_queue.run_repeating(refrescar_cache_job, interval=CACHE_TIEMPO, first=0)
+
     # Obtiene el puerto asignado por Railway (o usa 8080 por defecto)
     port = int(os.environ.get("PORT", 8080))
     logger.info(f"Configurando webhook para URL: {WEBHOOK_URL}{TOKEN} en puerto {port}")